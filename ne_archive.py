@@ -1,6 +1,7 @@
 """Archive all posts from a Nintendo Enthusiast author"""
 import asyncio
 import logging
+import sys
 from functools import wraps
 
 import click as click
@@ -24,6 +25,17 @@ ch.setFormatter(formatter)
 # add ch to logger
 LOG.addHandler(ch)
 
+# Use the faster libuv based event loop when it's installed
+try:
+    if sys.platform == "win32":
+        import winloop as uvloop
+    else:
+        import uvloop
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass
+
 
 def coro(f):
     """
@@ -61,7 +73,7 @@ def coro(f):
 )
 @coro
 async def ne_archive(author: str, debug: bool, max_backoff_override: float):
-    LOG.info(f"Archiving all posts from {author}")
+    LOG.info("Archiving all posts from %s", author)
     ne_scraper = NEArchiver(
         author=author, debug=debug, max_backoff_override=max_backoff_override
     )
@@ -1,150 +1,397 @@
 """Script to Archive Nintendo Enthusiast Posts"""
 
 import asyncio
+import json
 import logging
+import random
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import aiohttp as aiohttp
-from bs4 import BeautifulSoup
-from typing import List
+from aiohttp_client_cache import CachedSession, SQLiteBackend
+from aiolimiter import AsyncLimiter
+from email.utils import parsedate_to_datetime
+from selectolax.lexbor import LexborHTMLParser, LexborNode
+from typing import List, Optional, Set, TextIO
 from waybackpy import WaybackMachineSaveAPI
 from waybackpy.exceptions import TooManyRequestsError
 
 ONE_MINUTE = 60
+# Post urls already submitted to Wayback on previous runs, one per line
+ARCHIVED_URLS_FILE = ".archived_urls.txt"
+# Save Page Now allows at most 5 simultaneous captures and roughly 15 captures per minute
+MAX_CONCURRENT_SAVES = 5
+MAX_SAVES_PER_MINUTE = 15
+# Listing pages fetched alongside the first page, before the real page count is known
+SPECULATIVE_PAGES = 20
+# Listing pages are cached between runs so re-running after being rate limited doesn't refetch them
+PAGE_CACHE_FILE = ".ne_cache.sqlite"
+ONE_DAY = 24 * 60 * ONE_MINUTE
+
+# create logger once so creating more than one NEArchiver doesn't duplicate every record
+_LOG = logging.getLogger("NEArchiver")
+if not _LOG.handlers:
+    # create console handler and set level to debug.
+    # logging.StreamHandler(sys.stdout) to print to stdout instead of the default stderr
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.DEBUG)
+
+    # create formatter
+    formatter = logging.Formatter(
+        "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    )
+
+    # add formatter to ch
+    ch.setFormatter(formatter)
+
+    # add ch to logger
+    _LOG.addHandler(ch)
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Convert a Retry-After header, given either in seconds or as an HTTP date, to seconds"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
 
 
 class NEArchiver:
+    __slots__ = (
+        "_DEBUG",
+        "_back_off_timer_max",
+        "_back_off_timer_min",
+        "_spn_sem",
+        "_limiter",
+        "_save_executor",
+        "_LOG",
+        "_root_url",
+        "_user_agent",
+        "_archived_pages_path",
+        "_archived_pages_file",
+        "_archived_page_count",
+        "_back_off_attempt",
+        "_resume_at",
+        "_seen",
+        "_session",
+    )
+
     def __init__(self, author: str, debug: bool, max_backoff_override: float):
         """Instantiates top-level url to begin scraping from"""
         self._DEBUG = debug
-        # Timer in seconds
-        self._back_off_timer = 1.0
+        # Timers in minutes
         self._back_off_timer_max = max(60.0, max_backoff_override)
         self._back_off_timer_min = 1.0
-        self._posts_per_save = 5
-        # create logger
-        self._LOG = logging.getLogger("NEArchiver")
+        self._spn_sem = asyncio.BoundedSemaphore(MAX_CONCURRENT_SAVES)
+        self._limiter = AsyncLimiter(MAX_SAVES_PER_MINUTE, ONE_MINUTE)
+        # waybackpy is blocking so saves run on worker threads, one per allowed concurrent capture
+        self._save_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_SAVES)
+        self._LOG = _LOG
         if self._DEBUG:
             self._LOG.setLevel(logging.DEBUG)
         else:
             self._LOG.setLevel(logging.INFO)
-        # create console handler and set level to debug.
-        # logging.StreamHandler(sys.stdout) to print to stdout instead of the default stderr
-        ch = logging.StreamHandler()
-        ch.setLevel(logging.DEBUG)
-
-        # create formatter
-        formatter = logging.Formatter(
-            "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-        )
-
-        # add formatter to ch
-        ch.setFormatter(formatter)
-
-        # add ch to logger
-        self._LOG.addHandler(ch)
         self._root_url = f"https://www.nintendoenthusiast.com/author/{author}"
         self._user_agent = (
             "Mozilla/5.0 (Windows NT 5.1; rv:40.0) Gecko/20100101 Firefox/40.0"
         )
-        self._archived_page_urls = []
+        # Archived page links are streamed here as they come in so a crashed run keeps its progress
+        self._archived_pages_path = f"{author}_archived.jsonl"
+        self._archived_pages_file: Optional[TextIO] = None
+        self._archived_page_count = 0
+        # Shared by the archive workers so a rate limit hit by one pauses all of them
+        self._back_off_attempt = 0
+        self._resume_at = 0.0
+        self._seen: Set[str] = self._load_seen(ARCHIVED_URLS_FILE)
+        # Shared across all page fetches so connections are pooled and kept alive
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    @staticmethod
+    def _load_seen(path: str) -> Set[str]:
+        try:
+            with open(path, encoding="utf-8") as f:
+                return {line.strip() for line in f if line.strip()}
+        except FileNotFoundError:
+            return set()
+
+    def _record_archived_page(self, url: str, archived_page_url: str):
+        if self._archived_pages_file is None:
+            # Opened on the first archived page so an invalid author doesn't leave an empty file behind
+            self._archived_pages_file = open(
+                self._archived_pages_path, "a", encoding="utf-8", buffering=1
+            )
+        self._archived_pages_file.write(
+            json.dumps({"post": url, "archived": archived_page_url}) + "\n"
+        )
+        self._archived_page_count += 1
+        self._mark_seen(url)
+        self._LOG.info("%s", archived_page_url)
 
-    def _increment_backoff_timer(self):
-        self._back_off_timer = min(self._back_off_timer * 2, self._back_off_timer_max)
+    def _mark_seen(self, url: str):
+        self._seen.add(url)
+        with open(ARCHIVED_URLS_FILE, "a", encoding="utf-8") as f:
+            f.write(url + "\n")
 
-    def _decrement_backoff_timer(self):
-        self._back_off_timer = max(self._back_off_timer / 2, self._back_off_timer_min)
+    def _create_session(self) -> aiohttp.ClientSession:
+        return CachedSession(
+            cache=SQLiteBackend(PAGE_CACHE_FILE, expire_after=ONE_DAY),
+            headers={
+                "Accept-Encoding": "gzip, deflate",
+                "User-Agent": self._user_agent,
+            },
+            connector=aiohttp.TCPConnector(limit_per_host=8, ttl_dns_cache=300),
+        )
 
-    async def _get_author_posts(self, soup) -> List:
-        return (
-            soup.find_all("div", class_="mnmd-main-col")
-            .pop()
-            .find_all("h3", class_="post__title")
+    def _back_off_seconds(self, attempt: int, retry_after: Optional[float]) -> float:
+        """Wait what Wayback asked for, otherwise back off exponentially with jitter"""
+        if retry_after is not None:
+            # Never retry straight away on a zero or already passed Retry-After, and spread the workers out
+            back_off_seconds = max(retry_after, self._back_off_timer_min * ONE_MINUTE)
+            return back_off_seconds * (1.0 + 0.1 * random.random())
+        back_off_minutes = min(
+            self._back_off_timer_max, self._back_off_timer_min * 2**attempt
         )
+        return back_off_minutes * ONE_MINUTE * (0.5 + random.random())
+
+    def _get_author_posts(self, tree: LexborHTMLParser) -> List[LexborNode]:
+        """The post title links on a listing page"""
+        return tree.css("div.mnmd-main-col h3.post__title a")
+
+    def _page_url(self, page_number: int) -> str:
+        return f"{self._root_url}/page/{page_number}/"
 
-    async def _fetch_page(self, url: str) -> BeautifulSoup:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as r:
-                # Convert the response into an easily parsable object
-                text = await r.read()
-                soup = BeautifulSoup(text.decode("utf-8"), "html.parser")
-        return soup
-
-    async def _archive(self, author_post) -> str:
-        save_api = WaybackMachineSaveAPI(author_post.a["href"], self._user_agent)
-        archived_page_url = save_api.save()
+    @staticmethod
+    def _get_total_page_numbers(tree: LexborHTMLParser) -> int:
+        # Authors with a single page of posts have no pagination at all
+        pagination = tree.css("a.mnmd-pagination__item")
+        return int(pagination[-1].text(strip=True)) if pagination else 1
+
+    @staticmethod
+    async def _cancel_tasks(tasks: List[asyncio.Task]):
+        for task in tasks:
+            task.cancel()
+        # Wait for them to finish so no errors from pages past the end go unretrieved
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _fetch_page(self, url: str) -> LexborHTMLParser:
+        async with self._session.get(url) as r:
+            # Decode with the charset the server declares, then convert into an easily parsable object
+            text = await r.text()
+            tree = LexborHTMLParser(text)
+        return tree
+
+    async def _wait_for_resume(self):
+        """Sleeps until the shared back off is over, including any extension made while asleep"""
+        loop = asyncio.get_running_loop()
+        delay = self._resume_at - loop.time()
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self._resume_at - loop.time()
+
+    async def _archive(self, url: str) -> str:
+        async with self._spn_sem, self._limiter:
+            # A back off may have started while we were waiting on the semaphore or limiter
+            await self._wait_for_resume()
+            save_api = WaybackMachineSaveAPI(url, self._user_agent)
+            loop = asyncio.get_running_loop()
+            try:
+                archived_page_url = await loop.run_in_executor(
+                    self._save_executor, save_api.save
+                )
+            except TooManyRequestsError as e:
+                # waybackpy keeps the 429 response around but doesn't expose its headers on the exception
+                response = getattr(save_api, "response", None)
+                e.retry_after = _parse_retry_after(
+                    response.headers.get("Retry-After") if response is not None else None
+                )
+                raise
         return archived_page_url
 
-    async def archive(self):
-        """This code will only work on Windows as it stands now."""
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            url = await queue.get()
+            try:
+                # Wait out any back off another worker started
+                await self._wait_for_resume()
+                started_at = asyncio.get_running_loop().time()
+                archived_page_url = await self._archive(url)
+            except TooManyRequestsError as e:
+                self._LOG.error(e)
+                self._back_off(e)
+                queue.put_nowait(url)
+            except Exception as e:
+                # Skip it, it isn't marked as archived so the next run retries it
+                self._LOG.error("Failed to archive %s: %s", url, e)
+            else:
+                # Saves already running when a back off started don't show Wayback has let up
+                if started_at >= self._resume_at:
+                    self._back_off_attempt = 0
+                try:
+                    self._record_archived_page(url, archived_page_url)
+                except OSError as e:
+                    # Without a record the run can't be resumed, so stop instead of archiving more
+                    self._LOG.error(
+                        "Could not record archived page %s: %s", archived_page_url, e
+                    )
+                    raise
+                self._LOG.debug(
+                    "Archived %d posts. %d left.",
+                    self._archived_page_count,
+                    queue.qsize(),
+                )
+            finally:
+                queue.task_done()
+
+    def _back_off(self, error: TooManyRequestsError):
+        now = asyncio.get_running_loop().time()
+        if now < self._resume_at:
+            # Another worker was rate limited by the same burst and is already backing off
+            return
+        back_off_seconds = self._back_off_seconds(
+            self._back_off_attempt, getattr(error, "retry_after", None)
+        )
+        self._back_off_attempt += 1
+        self._resume_at = now + back_off_seconds
+        self._LOG.info("Backing off for %.0f second(s).", back_off_seconds)
+
+    async def _fetch_author_post_urls(self) -> List[str]:
+        """Collects the url of every post listed on the author's pages"""
+        # Get the first page, speculatively fetching the next few pages while we wait on it
+        self._LOG.info("Fetching %s...", self._root_url)
+        p1_task = asyncio.create_task(self._fetch_page(self._root_url))
+        speculative_tasks = [
+            asyncio.create_task(self._fetch_page(self._page_url(page_number)))
+            for page_number in range(2, 2 + SPECULATIVE_PAGES)
+        ]
         try:
-            # Get the first page
-            self._LOG.info(f"Fetching {self._root_url}...")
-            p1_soup = await self._fetch_page(self._root_url)
-            # Extract total page numbers
-            total_page_numbers = int(
-                p1_soup.find_all("a", class_="mnmd-pagination__item").pop().get_text()
+            p1_tree = await p1_task
+            if p1_tree.css_first("div.mnmd-main-col") is None:
+                # Not an author page, handled as an invalid author by _archive_all
+                raise IndexError(f"No posts found at {self._root_url}")
+            total_page_numbers = self._get_total_page_numbers(p1_tree)
+        except BaseException:
+            await self._cancel_tasks(speculative_tasks)
+            raise
+        # Drop speculative fetches past the last page and fetch whatever they didn't cover
+        await self._cancel_tasks(speculative_tasks[total_page_numbers - 1 :])
+        tasks = speculative_tasks[: total_page_numbers - 1]
+        for page_number in range(2 + len(tasks), total_page_numbers + 1):
+            tasks.append(
+                asyncio.create_task(self._fetch_page(self._page_url(page_number)))
             )
-            # Extract list of author posts from all pages
+        # Extract list of author posts from all pages
+        remaining_pages_trees = []
+        if tasks:
             self._LOG.info(
-                f"Extracting remaining {total_page_numbers - 1} pages of author posts..."
+                "Extracting remaining %d pages of author posts...",
+                total_page_numbers - 1,
             )
-            tasks = []
-            for page_number in range(2, total_page_numbers + 1):
-                tasks.append(
-                    asyncio.create_task(
-                        self._fetch_page(f"{self._root_url}/page/{page_number}/")
-                    )
-                )
-            remaining_pages_soup = await asyncio.gather(*tasks)
-            author_posts = await self._get_author_posts(p1_soup)
-            for page_soup in remaining_pages_soup:
-                author_posts.extend(await self._get_author_posts(page_soup))
+            remaining_pages_trees = await asyncio.gather(*tasks)
+        # Keep only the urls so each parse tree can be freed once we return
+        author_post_urls = [
+            author_post.attributes["href"]
+            for author_post in self._get_author_posts(p1_tree)
+        ]
+        for page_tree in remaining_pages_trees:
+            author_post_urls.extend(
+                author_post.attributes["href"]
+                for author_post in self._get_author_posts(page_tree)
+            )
+        return author_post_urls
+
+    async def archive(self):
+        """This code will only work on Windows as it stands now."""
+        try:
+            async with self._create_session() as self._session:
+                await self._archive_all()
+        finally:
+            self._session = None
+            if self._archived_pages_file is not None:
+                self._archived_pages_file.close()
+                self._archived_pages_file = None
+            self._save_executor.shutdown(wait=False)
+
+    async def _archive_all(self):
+        try:
+            author_post_urls = await self._fetch_author_post_urls()
             self._LOG.info(
-                f"Found {len(author_posts)} posts. Archiving them. Wayback Machine could try to fight us so this "
-                f"could take a while. "
+                "Found %d posts. Archiving them. Wayback Machine could try to fight us so this "
+                "could take a while. ",
+                len(author_post_urls),
             )
             self._LOG.info(
                 "Be prepared to let this run for 30 minutes to a day depending on how many posts you're "
                 "archiving."
             )
-            # Archive all posts
-            tasks = []
-            for idx, author_post in enumerate(author_posts):
-                tasks.append(asyncio.create_task(self._archive(author_post)))
-                if not len(tasks) % self._posts_per_save:
-                    try:
-                        self._archived_page_urls.extend(await asyncio.gather(*tasks))
-                    except TooManyRequestsError as e:
-                        self._LOG.error(e)
-                        self._LOG.info(
-                            f"Backing off for {self._back_off_timer} minute(s)."
-                        )
-                        time.sleep(self._back_off_timer * ONE_MINUTE)
-                        self._increment_backoff_timer()
-                        self._LOG.info("Resuming.")
-                        continue
-                    tasks.clear()
-                    self._LOG.debug(
-                        f"Archived {idx + 1} posts. Backing off for {self._back_off_timer} minute(s)"
-                    )
-                    time.sleep(self._back_off_timer * ONE_MINUTE)
-                    self._decrement_backoff_timer()
+            # Skip posts listed more than once, or archived on a previous run
+            unique_urls = list(dict.fromkeys(author_post_urls))
+            pending_urls = [url for url in unique_urls if url not in self._seen]
+            if len(unique_urls) < len(author_post_urls):
+                self._LOG.info(
+                    "Skipping %d posts that were listed more than once.",
+                    len(author_post_urls) - len(unique_urls),
+                )
+            if len(pending_urls) < len(unique_urls):
+                self._LOG.info(
+                    "Skipping %d posts that were already archived.",
+                    len(unique_urls) - len(pending_urls),
+                )
+            if not pending_urls:
+                self._LOG.info("Nothing new to archive.")
+                return
+            # Archive all posts, a fixed pool of workers keeps a save in flight per allowed concurrent capture
+            queue = asyncio.Queue()
+            for url in pending_urls:
+                queue.put_nowait(url)
+            workers = [
+                asyncio.create_task(self._worker(queue))
+                for _ in range(MAX_CONCURRENT_SAVES)
+            ]
+            join_task = asyncio.create_task(queue.join())
+            try:
+                # Workers only finish early by failing, stop then rather than wait on a queue nobody drains
+                await asyncio.wait(
+                    {join_task, *workers}, return_when=asyncio.FIRST_COMPLETED
+                )
+            finally:
+                join_task.cancel()
+                for worker in workers:
+                    worker.cancel()
+                await asyncio.gather(join_task, *workers, return_exceptions=True)
+            for worker in workers:
+                if not worker.cancelled() and worker.exception():
+                    raise worker.exception()
+            if self._archived_page_count < len(pending_urls):
+                self._LOG.info(
+                    "Archived %d of %d posts. Run again to retry the rest. The links to the archived pages are "
+                    "in %s",
+                    self._archived_page_count,
+                    len(pending_urls),
+                    self._archived_pages_path,
+                )
+                return
             self._LOG.info(
-                f"All {len(author_posts)} successfully archived. Here are the links to the archived pages:"
+                "All %d successfully archived. The links to the archived pages are in %s",
+                len(pending_urls),
+                self._archived_pages_path,
             )
-            for archived_page in self._archived_page_urls:
-                self._LOG.info(f"{archived_page}")
         except IndexError:
             self._LOG.error(
                 "Please check that the author named entered is valid. If you're sure that's right, reach out to "
                 "the code maintainer or debug the issue yourself."
             )
         except Exception as e:
-            self._LOG.error(f"Exception: {e}")
-            if self._archived_page_urls:
+            self._LOG.error("Exception: %s", e)
+            if self._archived_page_count:
                 self._LOG.info(
-                    f"Some author posts were successfully archived. Here are the links to the archived pages:"
+                    "%d author posts were successfully archived. The links to the archived pages are in %s",
+                    self._archived_page_count,
+                    self._archived_pages_path,
                 )
-                for archived_page in self._archived_page_urls:
-                    self._LOG.info(f"{archived_page}")